@@ -1,32 +1,102 @@
 import argparse
-import concurrent.futures
+import asyncio
+import atexit
+import functools
+import hashlib
+import io
 import json
 import os
+import random
 import re
+import sqlite3
 import sys
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from collections import namedtuple
 from datetime import datetime
 
 import backoff
+import httpx
+import numpy as np
 import openai
-from git import Repo, InvalidGitRepositoryError
+from openai import AsyncOpenAI, OpenAI
+from git import Repo, InvalidGitRepositoryError, GitCommandError
 from tqdm import tqdm
 import tiktoken
 from termcolor import colored
 
 
-# initialize openai api
-openai.api_key = os.getenv("OPENAI_API_KEY")
-if not openai.api_key:
-    print("OPENAI_API_KEY environment variable not found. Please enter it below:")
-    openai.api_key = input()
+def load_api_key():
+    # initialize openai api, when it's about to be used rather than on import, so --help works without a key
+    if openai.api_key:
+        return
+    openai.api_key = os.getenv("OPENAI_API_KEY")
     if not openai.api_key:
-        raise ValueError("No API Key provided. Terminating.")
+        print("OPENAI_API_KEY environment variable not found. Please enter it below:")
+        openai.api_key = input()
+        if not openai.api_key:
+            raise ValueError("No API Key provided. Terminating.")
+
+
+# Share pooled HTTP/2 connections across requests, rather than paying for a new TLS handshake on each one.
+# The clients are created on first use, and retries are handled by backoff, so the client's own retries are turned off.
+# The transports only retry failed connection attempts, which never reached the API.
+http_limits = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+http_timeout = httpx.Timeout(60.0, connect=10.0)
+client = None
+async_client = None
+
+
+def get_client():
+    global client
+    if client is None:
+        client = OpenAI(
+            api_key=openai.api_key,
+            max_retries=0,
+            http_client=httpx.Client(
+                transport=httpx.HTTPTransport(http2=True, retries=2, limits=http_limits),
+                timeout=http_timeout
+            )
+        )
+    return client
+
+
+def get_async_client():
+    # The async client's connections belong to the running event loop, so it's closed before the loop ends
+    global async_client
+    if async_client is None:
+        async_client = AsyncOpenAI(
+            api_key=openai.api_key,
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(http2=True, retries=2, limits=http_limits),
+                timeout=http_timeout
+            )
+        )
+    return async_client
+
+
+async def close_async_client():
+    global async_client
+    if async_client is not None:
+        await async_client.close()
+        async_client = None
+
+
+def close_client():
+    global client
+    if client is not None:
+        client.close()
+        client = None
+
+
+atexit.register(close_client)
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
 
 # Cache the output
+@functools.lru_cache(maxsize=None)
 def load_messages(filename):
     with open(filename, 'r') as file:
         messages = json.load(file)
@@ -36,31 +106,711 @@ def load_messages(filename):
 message_text = load_messages(os.path.join(script_dir, "messages.json"))
 
 
-def summarize(text, model="gpt-3.5-turbo"):
+def load_system_message(name):
+    with open(os.path.join(script_dir, "system", f"{name}.txt"), "r") as file:
+        return file.read()
+
+
+# The system prompts never change during a run, so read them once rather than on every request
+system_text = {
+    "commit_summarizer": load_system_message("commit_summarizer"),
+    "changelog_writer": load_system_message("changelog_writer"),
+}
+# Hashed once as well, for the cache keys of every request
+system_hash = {name: hashlib.sha256(text.encode("utf-8")).hexdigest() for name, text in system_text.items()}
+summary_prompt_hash = hashlib.sha256(message_text["commit_summarizer"]["summarize_commit_details"].encode("utf-8")).hexdigest()
+batch_prompt_hash = hashlib.sha256(message_text["commit_summarizer"]["summarize_batch_details"].encode("utf-8")).hexdigest()
+
+# Persistent cache for API responses, so re-runs don't pay for work that has already been done
+cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "logedit")
+cache_lock = threading.Lock()
+cache_connection = None
+
+
+def get_cache():
+    global cache_connection
+    with cache_lock:
+        if cache_connection is None:
+            os.makedirs(cache_dir, exist_ok=True)
+            cache_connection = sqlite3.connect(os.path.join(cache_dir, "cache.sqlite3"), check_same_thread=False)
+            cache_connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            cache_connection.commit()
+    return cache_connection
+
+
+def cache_get(key):
+    cache = get_cache()
+    with cache_lock:
+        row = cache.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def cache_set(key, value):
+    cache = get_cache()
+    with cache_lock:
+        cache.execute("INSERT OR REPLACE INTO responses (key, value) VALUES (?, ?)", (key, value))
+        cache.commit()
+
+
+def cache_key(*parts):
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def summary_cache_key(commit, model):
+    # Commits are immutable, so the hash, model and prompts fully determine the summary
+    return cache_key(
+        "summary",
+        commit.hexsha,
+        model,
+        system_hash["commit_summarizer"],
+        summary_prompt_hash,
+        batch_prompt_hash
+    )
+
+
+def prompt_cache_key(name):
+    # Requests that share a system prompt are routed to the same OpenAI prompt cache, so its prefix is reused
+    return "logedit-" + system_hash[name][:16]
+
+
+# Semantic cache for near-duplicate commits, using embedding similarity
+embedding_model = "text-embedding-3-small"
+embedding_lock = threading.Lock()
+embedding_index = {}
+# Summaries are only reused between commits summarized with the same prompts
+semantic_prompts_hash = cache_key(system_hash["commit_summarizer"], summary_prompt_hash, batch_prompt_hash)
+
+
+def semantic_summary_key(commit, model, threshold):
+    # Summaries reused from the semantic cache are approximate, so they're kept apart from the exact summaries
+    # and only reused by runs with the same threshold
+    return cache_key("semantic", commit.hexsha, model, semantic_prompts_hash, repr(threshold))
+
+
+def get_embedding_index(model):
+    # Load the normalized embeddings and their summaries for this model and these prompts into memory, once per run
+    if model not in embedding_index:
+        cache = get_cache()
+        with cache_lock:
+            cache.execute("CREATE TABLE IF NOT EXISTS semantic_summaries "
+                          "(model TEXT NOT NULL, prompts TEXT NOT NULL, embedding BLOB NOT NULL, summary TEXT NOT NULL)")
+            rows = cache.execute("SELECT embedding, summary FROM semantic_summaries WHERE model = ? AND prompts = ?",
+                                 (model, semantic_prompts_hash)).fetchall()
+        vectors = np.array([np.frombuffer(row[0], dtype=np.float32) for row in rows], dtype=np.float32)
+        embedding_index[model] = (vectors, [row[1] for row in rows])
+    return embedding_index[model]
+
+
+async def embed(text):
+    response = await get_async_client().embeddings.create(model=embedding_model, input=text[:8000])
+    vector = np.array(response.data[0].embedding, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def semantic_cache_get(vector, model, threshold):
+    with embedding_lock:
+        vectors, summaries = get_embedding_index(model)
+        if not summaries:
+            return None
+        scores = vectors @ vector
+        best = int(np.argmax(scores))
+        return summaries[best] if scores[best] >= threshold else None
+
+
+def semantic_cache_set(vector, model, summary):
+    with embedding_lock:
+        vectors, summaries = get_embedding_index(model)
+        embedding_index[model] = (np.vstack([vectors.reshape(-1, len(vector)), vector]), summaries + [summary])
+        cache = get_cache()
+        with cache_lock:
+            cache.execute("INSERT INTO semantic_summaries (model, prompts, embedding, summary) VALUES (?, ?, ?, ?)",
+                          (model, semantic_prompts_hash, vector.tobytes(), summary))
+            cache.commit()
+
+
+# Tags that follow the format of a version number (with optional v prefix)
+version_pattern = re.compile(r"^v?(\d+\.)*\d+$")
+
+
+def get_latest_version_tag(repo):
+    # Filter by name first, so only version tags need their commit loaded, and take the latest in a single pass
+    return max(
+        (tag for tag in repo.tags if version_pattern.match(tag.name)),
+        key=lambda t: t.commit.committed_datetime,
+        default=None
+    )
+
+
+# Conventional commit types whose message already says all a changelog needs. Breaking changes (`type!:`) don't match.
+trivial_commit_pattern = re.compile(r"^(chore|docs|style|test|ci|build)(\([^)]*\))?:")
+
+
+def get_trivial_summary(commit):
+    # Merge commits (whose changes are already in the commits they merge) and routine maintenance commits
+    # are described well enough by their message, so they don't need to be sent to the API
+    if len(commit.parents) > 1:
+        return "Merge commit. Its changes are summarized in the commits it merges."
+    lines = commit.message.strip().splitlines()
+    subject = lines[0] if lines else ""
+    if trivial_commit_pattern.match(subject):
+        return subject
+    return None
+
+
+# The parts of a commit that logedit needs, read straight from `git log` rather than loaded through GitPython
+CommitInfo = namedtuple("CommitInfo", ["hexsha", "parents", "committed_datetime", "message"])
+
+
+def parse_log_entry(entry):
+    header, _, diff = entry.partition('\x1e')
+    hexsha, parents, committed, message = header.split('\x1f', 3)
+    commit = CommitInfo(hexsha, tuple(parents.split()), datetime.fromisoformat(committed), message)
+    return diff.strip('\n'), commit
+
+
+def iter_commit_diffs(repo, rev_range):
+    # A single `git log --patch` gives the details and diff of every commit in the range,
+    # rather than forking `git diff` once per commit. Commits are yielded as soon as git writes them.
+    # Merge commits are never summarized, so git is left to skip their diffs (often the largest in the range).
+    process = repo.git.log(rev_range, '--patch', '--format=%x00%H%x1f%P%x1f%cI%x1f%B%x1e', '--no-color', '--no-ext-diff',
+                           as_process=True)
+
+    lines = None
+    for line in process.stdout:
+        line = line.decode("utf-8", "replace")
+        if line.startswith('\x00'):
+            if lines is not None:
+                yield parse_log_entry("".join(lines))
+            lines = [line[1:]]
+        elif lines is not None:
+            lines.append(line)
+    if lines is not None:
+        yield parse_log_entry("".join(lines))
+    process.wait()
+
+
+async def iterate_in_thread(iterable):
+    # Pull items from a blocking iterator in a worker thread, so the event loop keeps running while it waits
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    producer = loop.run_in_executor(None, produce)
+    while True:
+        item = await queue.get()
+        if item is done:
+            break
+        yield item
+    await producer
+
+
+@functools.lru_cache(maxsize=4)
+def get_encoding(model):
+    # Resolve the encoding for each model once, rather than on every call
+    return tiktoken.encoding_for_model(model)
+
+
+def get_retry_after(exception):
+    # The number of seconds the API asked us to wait before retrying, if it said
+    response = getattr(exception, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+def retry_after_or_expo(base=2, factor=5):
+    # Wait as long as the Retry-After header asks, otherwise back off exponentially with full jitter (up to 5, 10, 20, 40 seconds)
+    exception = yield
+    attempt = 0
+    while True:
+        wait = get_retry_after(exception)
+        if wait is None:
+            wait = random.uniform(0, factor * base ** attempt)
+        attempt += 1
+        exception = yield wait
+
+
+# Only retry errors that can go away on their own, so bugs fail straight away
+retry_on_api_errors = backoff.on_exception(
+    retry_after_or_expo,
+    (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError),
+    max_tries=5,
+    jitter=None
+)
+
+
+def count_tokens(text, model="gpt-3.5-turbo"):
+    return len(get_encoding(model).encode(text)) if text else 0
+
+
+def estimate_tokens(text, model="gpt-3.5-turbo", budget=None):
+    # Roughly 4 characters per token is close enough, unless the estimate is near the remaining budget
+    estimate = len(text) // 4
+    if budget is not None and estimate < budget * 0.8:
+        return estimate
+    return count_tokens(text, model)
+
+
+def truncate_tokens(text, model="gpt-3.5-turbo", max_tokens=2048):
     # Get encoding for gpt-3.5-turbo
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = get_encoding(model)
+
+    # Tokens are rarely longer than 6 characters, so cut the text down before encoding it,
+    # rather than encoding a huge diff only to throw most of it away
+    max_chars = max_tokens * 6
+    tokens = encoding.encode(text[:max_chars])
+    if len(tokens) <= max_tokens and len(text) <= max_chars:
+        return text
 
     # Limit the text to 2048 tokens.
     # GPT-3.5 has a limit of 4096 tokens, but we need to leave room for the system message and response.
-    text = encoding.decode(encoding.encode(text)[:2048])
+    return encoding.decode(tokens[:max_tokens]) + "\n… [diff truncated]"
+
+
+# Lockfiles and generated files, whose diffs say nothing useful about a commit
+generated_file_pattern = re.compile(
+    r"(^|/)(package-lock\.json|yarn\.lock|pnpm-lock\.yaml|composer\.lock|poetry\.lock|Pipfile\.lock|Cargo\.lock|go\.sum)$"
+    r"|\.min\.(js|css)$|\.map$|\.pb\.go$|_pb2\.py$|\.generated\."
+)
+
+
+def prune_diff(diff, max_line_length=500):
+    # Keep only the headers of the parts of a diff that say nothing useful about the commit: lockfiles and
+    # generated files, and hunks that change very long lines (minified or generated code)
+    lines = []
+    hunk = []
+    skip_file = False
+
+    def flush_hunk():
+        if any(line[:1] in ("+", "-") and len(line) > max_line_length for line in hunk[1:]):
+            lines.append(hunk[0])
+            lines.append("[hunk omitted: contains minified or generated lines]")
+        else:
+            lines.extend(hunk)
+        hunk.clear()
+
+    for line in diff.split("\n"):
+        if line.startswith("diff --git "):
+            if hunk:
+                flush_hunk()
+            lines.append(line)
+            skip_file = bool(generated_file_pattern.search(line.rsplit(" b/", 1)[-1]))
+            if skip_file:
+                lines.append("[diff omitted: lockfile or generated file]")
+            continue
+        if skip_file:
+            continue
+        if line.startswith("@@"):
+            if hunk:
+                flush_hunk()
+            hunk.append(line)
+        elif hunk:
+            hunk.append(line)
+        else:
+            lines.append(line)
+    if hunk:
+        flush_hunk()
+    return "\n".join(lines)
+
+
+def get_empty_diff_summary(diff):
+    # A summary for commits with nothing left to summarize once their diff is pruned, so they don't need a request
+    if not diff.strip():
+        return "Empty commit, with no file changes."
+    if all(line.startswith("diff --git ") or line == "[diff omitted: lockfile or generated file]" for line in diff.split("\n")):
+        return "Only updates lockfiles or generated files."
+    return None
+
+
+def summary_messages(text):
+    return [
+        {"role": "system", "content": system_text["commit_summarizer"]},
+        {"role": "user", "content": message_text["commit_summarizer"]["summarize_commit_details"].format(text)}
+    ]
+
+
+async def summarize(text, model="gpt-3.5-turbo"):
+    messages = summary_messages(text)
+
+    completion = await get_async_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0.25,
+        extra_body={"prompt_cache_key": prompt_cache_key("commit_summarizer")}
+    )
+    return completion.choices[0].message.content
 
-    with open(os.path.join(script_dir, "./system/commit_summarizer.txt"), "r") as file:
-        system_message = file.read()
 
+async def summarize_batch(texts, model="gpt-3.5-turbo"):
+    commits = "\n\n---\n\n".join(f"Commit {number}:\n{text}" for number, text in enumerate(texts, 1))
     messages = [
-        {"role": "system", "content": system_message},
-        {"role": "user", "content": message_text["commit_summarizer"]["summarize_commit_details"].format(text)}
+        {"role": "system", "content": system_text["commit_summarizer"]},
+        {"role": "user", "content": message_text["commit_summarizer"]["summarize_batch_details"].format(commits)}
     ]
 
-    completion = openai.ChatCompletion.create(
+    completion = await get_async_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0.25,
+        response_format={"type": "json_object"},
+        extra_body={"prompt_cache_key": prompt_cache_key("commit_summarizer")}
+    )
+
+    # Return None if the model didn't give exactly one summary per commit, so the caller can fall back
+    try:
+        summaries = json.loads(completion.choices[0].message.content)["summaries"]
+    except (ValueError, KeyError, TypeError):
+        return None
+    if not isinstance(summaries, list) or len(summaries) != len(texts) or not all(isinstance(summary, str) for summary in summaries):
+        return None
+    return summaries
+
+
+async def summarize_with_batch_api(texts, model="gpt-3.5-turbo", batch_id=None, use_cache=True, poll_interval=60, progress=None):
+    # Summarize commits through OpenAI's Batch API, which costs half as much and has its own rate limits,
+    # but can take up to 24 hours. texts maps each commit's hash to its text, and the summaries come back the same way.
+    client = get_async_client()
+
+    # Remember the batch submitted for these commits, so running the same command again picks it up
+    # instead of paying for a second batch
+    job_key = cache_key("batch", model, system_hash["commit_summarizer"], summary_prompt_hash, batch_prompt_hash, *sorted(texts))
+    batch = None
+    if batch_id is None and use_cache:
+        batch_id = cache_get(job_key)
+        if batch_id is not None:
+            batch = await client.batches.retrieve(batch_id)
+            if batch.status in ("failed", "expired", "cancelling", "cancelled"):
+                batch = None
+    elif batch_id is not None:
+        batch = await client.batches.retrieve(batch_id)
+
+    if batch is None:
+        requests = [
+            json.dumps({
+                "custom_id": hexsha,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": model,
+                    "messages": summary_messages(text),
+                    "temperature": 0.25,
+                    "prompt_cache_key": prompt_cache_key("commit_summarizer")
+                }
+            })
+            for hexsha, text in texts.items()
+        ]
+        batch_file = await client.files.create(file=("logedit-batch.jsonl", "\n".join(requests).encode("utf-8")), purpose="batch")
+        batch = await client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        cache_set(job_key, batch.id)
+    print(colored(f"\nWaiting for batch {batch.id}. If interrupted, resume it with --batch-resume {batch.id}", 'yellow'))
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        if progress is not None and batch.request_counts is not None:
+            progress.set_postfix_str(f"batch {batch.status}, {batch.request_counts.completed}/{batch.request_counts.total} done")
+        await asyncio.sleep(poll_interval)
+        batch = await client.batches.retrieve(batch.id)
+
+    if batch.status != "completed":
+        print(colored(f"\nBatch {batch.id} {batch.status}, only the commits it finished will be summarized.", 'red'))
+
+    # Expired batches still return the requests they finished
+    summaries = {}
+    if batch.output_file_id is not None:
+        output = await client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            if not line:
+                continue
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if response.get("status_code") == 200:
+                summaries[result["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+    return summaries
+
+
+class RateLimiter:
+    # Keeps requests under OpenAI's requests-per-minute and tokens-per-minute limits, so a large release is sent
+    # at the highest allowed rate instead of bursting into 429s. Both budgets refill continuously.
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute or float("inf")
+        self.tokens_per_minute = tokens_per_minute or float("inf")
+        self.available_requests = self.requests_per_minute
+        self.available_tokens = self.tokens_per_minute
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        # Unset limits stay at infinity, and are left alone so the arithmetic never turns them into nan
+        now = time.monotonic()
+        minutes = (now - self.updated) / 60
+        self.updated = now
+        if self.requests_per_minute != float("inf"):
+            self.available_requests = min(self.requests_per_minute, self.available_requests + minutes * self.requests_per_minute)
+        if self.tokens_per_minute != float("inf"):
+            self.available_tokens = min(self.tokens_per_minute, self.available_tokens + minutes * self.tokens_per_minute)
+
+    async def acquire(self, tokens):
+        # Waiting while holding the lock lets requests through in the order they asked
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self.lock:
+            while True:
+                self.refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                # Only a limit that has been set can need waiting for
+                waits = []
+                if self.requests_per_minute != float("inf"):
+                    waits.append((1 - self.available_requests) * 60 / self.requests_per_minute)
+                if self.tokens_per_minute != float("inf"):
+                    waits.append((tokens - self.available_tokens) * 60 / self.tokens_per_minute)
+                await asyncio.sleep(max(waits))
+
+
+async def summarize_commits(commit_diffs, total, semantic_threshold=None, max_concurrency=20, commits_per_request=5,
+                            max_batch_tokens=12000, requests_per_minute=None, tokens_per_minute=None, use_cache=True,
+                            batch_api=False, batch_id=None):
+    model = "gpt-3.5-turbo"
+
+    # Bound the number of requests in flight, rather than the number of threads
+    semaphore = asyncio.Semaphore(max_concurrency)
+    rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    system_tokens = count_tokens(system_text["commit_summarizer"], model)
+    progress = tqdm(desc="Summarizing commits", total=total)
+
+    @retry_on_api_errors
+    async def summarize_with_retries(texts):
+        await rate_limiter.acquire(system_tokens + sum(len(text) // 4 for text in texts))
+        # Only hold the semaphore during the request, not while backing off
+        async with semaphore:
+            if len(texts) == 1:
+                return [await summarize(texts[0], model=model)]
+            return await summarize_batch(texts, model=model)
+
+    @retry_on_api_errors
+    async def embed_with_retries(text):
+        # Embeddings go through the same limits as summaries, so the semantic cache can't burst past them
+        await rate_limiter.acquire(len(text[:8000]) // 4)
+        async with semaphore:
+            return await embed(text)
+
+    commits, keys, summaries = [], [], []
+
+    async def process_batch(texts):
+        batch_size = len(texts)
+        try:
+            # Reuse the summaries of near-identical commits, if the semantic cache is enabled
+            vectors = {}
+            if semantic_threshold is not None:
+                results = await asyncio.gather(*(embed_with_retries(text) for text in texts.values()), return_exceptions=True)
+                vectors = {index: vector for index, vector in zip(texts, results) if not isinstance(vector, Exception)}
+                for index, vector in vectors.items():
+                    summaries[index] = semantic_cache_get(vector, model, semantic_threshold)
+                    # Remember the reused summary for this commit, so re-runs don't embed it again
+                    if summaries[index] is not None:
+                        cache_set(semantic_summary_key(commits[index], model, semantic_threshold), summaries[index])
+                texts = {index: text for index, text in texts.items() if summaries[index] is None}
+                if not texts:
+                    return
+
+            results = await summarize_with_retries(list(texts.values()))
+            errors = []
+            if results is None:
+                # The batched response couldn't be matched up with the commits, so summarize them one at a time,
+                # keeping the summaries that succeed even if some commits fail
+                results = []
+                for result in await asyncio.gather(*(summarize_with_retries([text]) for text in texts.values()),
+                                                   return_exceptions=True):
+                    if isinstance(result, Exception):
+                        errors.append(result)
+                        results.append(None)
+                    else:
+                        results.append(result[0])
+            for index, summary in zip(texts, results):
+                if summary is None:
+                    continue
+                summaries[index] = summary
+                cache_set(keys[index], summary)
+                if index in vectors:
+                    semantic_cache_set(vectors[index], model, summary)
+            if errors:
+                raise errors[0]
+        finally:
+            progress.update(batch_size)
+
+    async def process_with_batch_api(texts):
+        try:
+            results = await summarize_with_batch_api({commits[index].hexsha: text for index, text in texts.items()},
+                                                     model, batch_id, use_cache, progress=progress)
+            for index in texts:
+                summaries[index] = results.get(commits[index].hexsha)
+                if summaries[index] is not None:
+                    cache_set(keys[index], summaries[index])
+        finally:
+            progress.update(len(texts))
+
+    # Start summarizing each batch as soon as it's full, while git is still producing the remaining diffs.
+    # gpt-3.5-turbo has a 16k token context window, so a 12k token batch leaves room for the prompt and the summaries.
+    tasks = []
+    batch, batch_tokens = {}, 0
+    # Commits with identical diffs (cherry-picks, backports) share the summary of the first one
+    diff_indexes, duplicates = {}, {}
+    async for diff, commit in iterate_in_thread(commit_diffs):
+        index = len(commits)
+        commits.append(commit)
+        keys.append(summary_cache_key(commit, model))
+        summaries.append(get_trivial_summary(commit))
+        if summaries[index] is not None:
+            progress.update()
+            continue
+
+        if diff:
+            digest = hashlib.blake2b(diff.encode("utf-8"), digest_size=16).digest()
+            if digest in diff_indexes:
+                duplicates[index] = diff_indexes[digest]
+                progress.update()
+                continue
+            diff_indexes[digest] = index
+
+        summaries[index] = cache_get(keys[index]) if use_cache else None
+        if summaries[index] is None and use_cache and semantic_threshold is not None and not batch_api:
+            summaries[index] = cache_get(semantic_summary_key(commit, model, semantic_threshold))
+        if summaries[index] is not None:
+            progress.update()
+            continue
+
+        diff = prune_diff(diff)
+        summaries[index] = get_empty_diff_summary(diff)
+        if summaries[index] is not None:
+            progress.update()
+            continue
+
+        text = truncate_tokens(commit.message + "\n" + diff, model)
+        if batch_api:
+            # Every commit goes into a single Batch API job, submitted once all the diffs have been read
+            batch[index] = text
+            continue
+        tokens = estimate_tokens(text, model, max_batch_tokens - batch_tokens)
+        if batch and (batch_tokens + tokens > max_batch_tokens or len(batch) >= commits_per_request):
+            tasks.append(asyncio.create_task(process_batch(batch)))
+            batch, batch_tokens = {}, 0
+        batch[index] = text
+        batch_tokens += tokens
+    if batch:
+        tasks.append(asyncio.create_task(process_with_batch_api(batch) if batch_api else process_batch(batch)))
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    progress.close()
+    await close_async_client()
+
+    for result in results:
+        if isinstance(result, Exception):
+            print(colored(f"An error occurred: {result}", 'red'))
+
+    for index, original_index in duplicates.items():
+        summaries[index] = summaries[original_index]
+        if summaries[index] is not None:
+            cache_set(keys[index], summaries[index])
+
+    # Summaries are stored by commit position, so they come back in commit order no matter when each request finished.
+    # git lists the newest commit first, but the changelog prompt expects them from oldest to newest.
+    formatted_summaries = []
+    for commit, summary in zip(reversed(commits), reversed(summaries)):
+        if summary is None:
+            continue
+        timestamp = commit.committed_datetime.isoformat()  # ISO 8601 format
+        formatted_commit_info = f"Commit: {commit.hexsha[:6]}\nTimestamp: {timestamp}\nMessage: {commit.message}\nSummary: {summary}"
+        formatted_summaries.append(formatted_commit_info)
+    return formatted_summaries
+
+
+def get_changelog_tail(changelog_file, lines=40, block_size=16384):
+    # Read only the end of the changelog, one block at a time backwards, until it holds enough lines.
+    # Each byte is read at most once, however long the changelog is.
+    with open(changelog_file, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        position = file.tell()
+        blocks, newlines = [], 0
+        while position > 0 and newlines <= lines:
+            step = min(block_size, position)
+            position -= step
+            file.seek(position)
+            block = file.read(step)
+            # Line endings may be \n, \r\n or \r, and a \r\n may be split between this block and the next
+            newlines += block.count(b"\n") + block.count(b"\r") - block.count(b"\r\n")
+            if blocks and block.endswith(b"\r") and blocks[-1].startswith(b"\n"):
+                newlines -= 1
+            blocks.append(block)
+    # Split the tail the way reading the file in text mode would, with universal newlines
+    tail = io.TextIOWrapper(io.BytesIO(b"".join(reversed(blocks))), encoding="utf-8", errors="replace")
+    return tail.readlines()[-lines:]
+
+
+@retry_on_api_errors
+def start_completion(messages, model, temperature, cache_name=None):
+    # Only starting the stream is retried, since a retry part way through would print the entry twice
+    return get_client().chat.completions.create(
         model=model,
         messages=messages,
-        temperature=0.25
+        temperature=temperature,
+        stream=True,
+        extra_body={"prompt_cache_key": prompt_cache_key(cache_name)} if cache_name else None
     )
-    return completion.choices[0].message['content']
 
 
-def main(current_version="HEAD", changelog_file="CHANGELOG.md", model="gpt-4", append=False):
+def stream_completion(messages, model, temperature, cache_name=None):
+    # Print the completion as it's generated, rather than waiting for the whole response
+    completion = start_completion(messages, model, temperature, cache_name)
+
+    content = []
+    for chunk in completion:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            sys.stdout.write(delta)
+            sys.stdout.flush()
+            content.append(delta)
+    print()
+    return "".join(content)
+
+
+def generate_changelog_entry(messages, model, use_cache=True):
+    key = cache_key("changelog", model, json.dumps(messages, sort_keys=True))
+    new_changelog_entry = cache_get(key) if use_cache else None
+    if new_changelog_entry is not None:
+        print(new_changelog_entry)
+        return new_changelog_entry
+
+    # Rather than checking model access up front on every run, fall back when the request itself is refused
+    try:
+        new_changelog_entry = stream_completion(messages, model, temperature=0.1, cache_name="changelog_writer")
+    except openai.NotFoundError as e:
+        if model == "gpt-3.5-turbo":
+            raise
+        print(colored(f"{model} model is not available for this user. It is recommended. Please check your access permissions. Defaulting to GPT-3.5 Turbo. Error: {e}", 'yellow'))
+        return generate_changelog_entry(messages, "gpt-3.5-turbo", use_cache)
+
+    cache_set(key, new_changelog_entry)
+    return new_changelog_entry
+
+
+# Releases with more commits than this need to be confirmed with --yes, in case the range is wrong
+large_release_commits = 200
+
+
+def main(current_version="HEAD", changelog_file="CHANGELOG.md", model="gpt-4", append=False, semantic_threshold=None,
+         commits_per_request=5, max_batch_tokens=12000, max_concurrency=20, requests_per_minute=None,
+         tokens_per_minute=None, use_cache=True, batch_api=False, batch_id=None, assume_yes=False):
     if current_version is None or changelog_file is None:
         print(colored("Error: Missing required arguments: 'current_version' and 'changelog_file'", 'red'))
         return
@@ -71,62 +821,53 @@ def main(current_version="HEAD", changelog_file="CHANGELOG.md", model="gpt-4", a
         print(colored(f"The current directory ({os.getcwd()}) is not a valid Git repository. Please navigate to a Git repository and try again.", 'red'))
         sys.exit(1)
 
+    load_api_key()
+
     if ':' in current_version:
-        previous_version, current_version = current_version.split(':')
+        previous_version, current_version = current_version.rsplit(':', 1)
     else:
-        # get all tags in repo
-        tags = sorted(repo.tags, key=lambda t: t.commit.committed_datetime)
-
-        # Filter for only tags that follow the format of a version number (with optional v prefix)
-        version_tags = [tag for tag in tags if re.match(r"^v?(\d+\.)*\d+$", str(tag))]
-
         # find the most recent version
-        previous_version = version_tags[-1] if version_tags else None
+        previous_version = get_latest_version_tag(repo)
+
+    # Without a previous version the range would cover the whole history, so refuse rather than summarize all of it
+    if previous_version is None:
+        print(colored("No version tags found. Please give the previous version with --version previous_version:current_version.", 'red'))
+        sys.exit(1)
 
     print(colored(f"Previous version is: {previous_version}", 'yellow'))
     print(colored(f"Current version is: {current_version}", 'yellow'))
 
-    # get commits between recent version and current version
-    commits = list(repo.iter_commits(f'{previous_version}..HEAD'))
+    # Check the range before any API calls are made. The current version is usually a new release name
+    # that hasn't been tagged yet, so the range always ends at HEAD.
+    try:
+        repo.git.rev_parse('--verify', '--quiet', f'{previous_version}^{{commit}}')
+    except GitCommandError:
+        print(colored(f"Previous version '{previous_version}' does not name a commit in this repository.", 'red'))
+        sys.exit(1)
 
-    print(colored(f"Total commits: {len(commits)}", 'cyan'))
+    # count the commits between recent version and current version
+    rev_range = f'{previous_version}..HEAD'
+    total = int(repo.git.rev_list('--count', rev_range))
 
-    # define the backoff strategy - 5, 10, 20 seconds
-    backoff_strategy = backoff.on_exception(backoff.expo, (Exception,), max_tries=3, base=2, factor=5)
+    print(colored(f"Total commits: {total}", 'cyan'))
 
-    @backoff_strategy
-    def process_commit(diff, commit):
-        text = commit.message + "\n" + diff
-        summary = summarize(text, model="gpt-3.5-turbo")
-        timestamp = commit.committed_datetime.isoformat()  # ISO 8601 format
-        formatted_commit_info = f"Commit: {commit.hexsha[:6]}\nTimestamp: {timestamp}\nMessage: {commit.message}\nSummary: {summary}"
-        return formatted_commit_info
-
-    # get all commit diffs in a single thread
-    commit_diffs = []
-    for commit in commits:
-        diff = repo.git.diff(commit.parents[0].hexsha, commit.hexsha)
-        commit_diffs.append((diff, commit))
-
-    # loop over all commits and get summaries in parallel
-    summaries = []
-    with ThreadPoolExecutor(max_workers=3) as executor:
-        futures = {executor.submit(process_commit, diff, commit) for diff, commit in commit_diffs}
-        for future in tqdm(concurrent.futures.as_completed(futures), desc="Summarizing commits", total=len(commits)):
-            try:
-                summaries.append(future.result())
-            except Exception as e:
-                print(colored(f"An error occurred: {e}", 'red'))
+    if total > large_release_commits and not assume_yes:
+        print(colored(f"Summarizing {total} commits may take a while and cost more than expected. "
+                      "Run again with --yes to go ahead.", 'red'))
+        sys.exit(1)
 
-    # read the tail of the current changelog file
-    with open(changelog_file, 'r') as file:
-        last_lines = file.readlines()[-40:]
+    # stream all commits and their diffs from a single git process, and summarize them concurrently as they arrive
+    commit_diffs = iter_commit_diffs(repo, rev_range)
+    summaries = asyncio.run(summarize_commits(commit_diffs, total, semantic_threshold, max_concurrency=max_concurrency,
+                                              commits_per_request=commits_per_request, max_batch_tokens=max_batch_tokens,
+                                              requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute,
+                                              use_cache=use_cache, batch_api=batch_api, batch_id=batch_id))
 
-    with open(os.path.join(script_dir, "./system/changelog_writer.txt"), "r") as file:
-        system_message = file.read()
+    # read the tail of the current changelog file
+    last_lines = get_changelog_tail(changelog_file)
 
     messages = [
-        {"role": "system", "content": system_message},
+        {"role": "system", "content": system_text["changelog_writer"]},
         {
             "role": "user",
             "content": message_text["changelog_writer"]["tail_changelog_user"].format("".join(last_lines))
@@ -144,12 +885,17 @@ def main(current_version="HEAD", changelog_file="CHANGELOG.md", model="gpt-4", a
             "content": message_text["changelog_writer"]["known_version_user"].format(current_version)
         })
 
-    messages.append({
-        "role": "user",
-        "content": message_text["changelog_writer"]["releasing_date_user"].format(datetime.now().date().isoformat())
-    })
-
+    # Keep the content that changes between runs (today's date and the summaries) at the end of the prompt,
+    # so the stable prefix can be served from OpenAI's prompt cache
     messages.extend([
+        {
+            "role": "user",
+            "content": message_text["changelog_writer"]["new_changelog_entry_user"].format(current_version)
+        },
+        {
+            "role": "user",
+            "content": message_text["changelog_writer"]["releasing_date_user"].format(datetime.now().date().isoformat())
+        },
         {
             "role": "user",
             "content": message_text["changelog_writer"]["commit_summaries_user"].format(
@@ -158,23 +904,12 @@ def main(current_version="HEAD", changelog_file="CHANGELOG.md", model="gpt-4", a
                 "\n\n---\n\n".join(summaries)
             )
         },
-        {
-            "role": "user",
-            "content": message_text["changelog_writer"]["new_changelog_entry_user"].format(current_version)
-        },
     ])
 
     # generate a new changelog entry using OpenAI's API
     print(colored(f"Summarized commits, generating changelog entry using {model}.", 'green'))
-    completion = openai.ChatCompletion.create(
-        model=model,
-        messages=messages,
-        temperature=0.1
-    )
-    new_changelog_entry = completion.choices[0].message['content']
-
     print(colored(f"\nNew Changelog Entry:\n", 'blue'))
-    print(new_changelog_entry)
+    new_changelog_entry = generate_changelog_entry(messages, model, use_cache)
 
     # append new changelog entry to the file if --append is specified
     if append:
@@ -192,22 +927,35 @@ def entrypoint():
                         help="Use GPT-3.5 Turbo model if specified, otherwise use GPT-4.")
     parser.add_argument('--append', '-a', action='store_true',
                         help="Automatically append the new changelog to the original file.")
+    parser.add_argument('--semantic-cache', type=float, nargs='?', const=0.95, default=None, metavar='THRESHOLD',
+                        help="Reuse summaries of near-identical commits whose embedding similarity is above THRESHOLD (default 0.95).")
+    parser.add_argument('--commits-per-request', type=int, default=5, metavar='N',
+                        help="Maximum number of commits to summarize in a single API request (default 5).")
+    parser.add_argument('--concurrency', type=int, default=20, metavar='N',
+                        help="Maximum number of summary requests to have in flight at once (default 20).")
+    parser.add_argument('--max-requests-per-minute', type=int, default=None, metavar='N',
+                        help="Limit summary requests to your OpenAI requests-per-minute rate limit.")
+    parser.add_argument('--max-tokens-per-minute', type=int, default=None, metavar='N',
+                        help="Limit summary requests to your OpenAI tokens-per-minute rate limit.")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Ignore cached summaries and changelog entries, and replace them with freshly generated ones.")
+    parser.add_argument('--batch', action='store_true',
+                        help="Summarize commits through OpenAI's Batch API, at half the cost. Batches can take up to 24 hours.")
+    parser.add_argument('--batch-resume', type=str, default=None, metavar='BATCH_ID',
+                        help="Wait for a batch submitted by an earlier --batch run, instead of submitting a new one.")
+    parser.add_argument('--yes', '-y', action='store_true',
+                        help=f"Summarize the commits even if there are more than {large_release_commits} of them.")
     args = parser.parse_args()
 
     if '--help' in sys.argv or '-h' in sys.argv:
         parser.print_help()
     else:
         model = "gpt-3.5-turbo" if args.gpt3 else "gpt-4"
-
-        # If we want to use GPT-4, we need to check that it's available for this user, otherwise show a warning
-        if model == "gpt-4":
-            try:
-                openai.Model.retrieve(model)
-            except Exception as e:
-                print(colored(f"GPT-4 model is not available for this user. It is recommended. Please check your access permissions. Defaulting to GPT-3.5 Turbo. Error: {e}",'yellow'))
-                model = "gpt-3.5-turbo"
-
-        main(args.version, args.changelog, model, args.append)
+        main(args.version, args.changelog, model, args.append, args.semantic_cache,
+             commits_per_request=args.commits_per_request, max_concurrency=args.concurrency,
+             requests_per_minute=args.max_requests_per_minute, tokens_per_minute=args.max_tokens_per_minute,
+             use_cache=not args.no_cache, batch_api=args.batch or args.batch_resume is not None,
+             batch_id=args.batch_resume, assume_yes=args.yes)
 
 
 if __name__ == "__main__":